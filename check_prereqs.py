@@ -5,43 +5,257 @@ This script verifies that all required components are properly configured.
 """
 
 import os
+import re
 import sys
 import json
+import argparse
+import errno
+import select
 import socket
 import platform
 import subprocess
+import http.client
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps
 from pathlib import Path
-from dotenv import load_dotenv
+from config import CREDENTIALS_FILE, env, load_oauth_client
 
-def print_status(component, status, details=None):
-    """Print a formatted status message."""
+NEO4J_CONTAINER = 'neo4j-local-analyzer'
+DOCKER_SOCKET = '/var/run/docker.sock'
+# Upper bound for any docker CLI call; a loaded daemon can otherwise hang indefinitely
+DOCKER_CLI_TIMEOUT = 3
+DOCKER_HUNG_MSG = f"Docker hung >{DOCKER_CLI_TIMEOUT}s — daemon overloaded or stuck. Try restarting Docker."
+# How a hung daemon surfaces: a CLI timeout, or a socket timeout on the Engine API
+_DOCKER_TIMEOUTS = (subprocess.TimeoutExpired, TimeoutError)
+
+# Host facts that cannot change during a run
+_IS_ARM = platform.machine() in ('arm64', 'aarch64')
+_COMPOSE_CMD = "docker-compose up -d neo4j" if os.path.exists('/usr/local/bin/docker-compose') else "docker compose up -d neo4j"
+
+# Placeholder markers used in .env.example values
+_DEFAULT_RE = re.compile(r'YOUR_|your-')
+
+# Outcome of a single check; `notes` are informational lines shown under the status
+CheckResult = namedtuple('CheckResult', ['component', 'status', 'details', 'notes'], defaults=(None, ()))
+
+class _DockerSocketConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker Engine API over its UNIX socket."""
+    
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=DOCKER_CLI_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def _docker_api(path):
+    """GET a Docker Engine API path, returning (status, body) without forking the docker CLI."""
+    conn = _DockerSocketConnection()
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def _run_once(func):
+    """Memoize a zero-argument helper across threads, including the exception it raised.
+
+    Unlike lru_cache, concurrent first callers wait for a single call instead of all
+    missing the cache, and a docker timeout is paid once rather than once per check.
+    """
+    lock = threading.Lock()
+    outcome = []
+    
+    @wraps(func)
+    def wrapper():
+        with lock:
+            if not outcome:
+                try:
+                    outcome.append((func(), None))
+                except Exception as e:
+                    outcome.append((None, e))
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+    return wrapper
+
+def _docker_socket_available():
+    """Check whether the Docker UNIX socket can be used (not on Windows/Docker Desktop named pipes)."""
+    return hasattr(socket, 'AF_UNIX') and os.path.exists(DOCKER_SOCKET)
+
+@_run_once
+def _neo4j_container_info():
+    """Inspect the Neo4j container once, returning its state and config (None if it doesn't exist)."""
+    # One inspect answers both "is it running?" and "what is NEO4J_AUTH?"
+    if _docker_socket_available():
+        status, body = _docker_api(f"/containers/{NEO4J_CONTAINER}/json")
+        return json.loads(body) if status == 200 else None
+    
+    result = subprocess.run(
+        ['docker', 'inspect', NEO4J_CONTAINER, '--format', '{{json .}}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False,
+        timeout=DOCKER_CLI_TIMEOUT
+    )
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)
+
+def _neo4j_container_env():
+    """Return the Neo4j container's environment as a dict, or None if unavailable."""
+    try:
+        info = _neo4j_container_info()
+    except Exception:
+        return None
+    if info is None:
+        return None
+    
+    container_env = {}
+    for line in (info.get('Config') or {}).get('Env') or []:
+        key, sep, value = line.partition('=')
+        if sep:
+            container_env[key] = value
+    return container_env
+
+def _neo4j_container_running():
+    """Check whether the Neo4j container is up."""
+    info = _neo4j_container_info()
+    return info is not None and info.get('State', {}).get('Status') == 'running'
+
+@_run_once
+def _docker_info():
+    """Return the Docker engine's info report, or None if the daemon doesn't respond."""
+    if _docker_socket_available():
+        try:
+            status, body = _docker_api('/info')
+        except TimeoutError:
+            raise  # The daemon is there but stuck; callers report DOCKER_HUNG_MSG
+        except OSError:
+            return None
+        return json.loads(body) if status == 200 else None
+    
+    try:
+        result = subprocess.run(['docker', 'info', '--format', '{{json .}}'], 
+                                stdout=subprocess.PIPE, 
+                                stderr=subprocess.DEVNULL, 
+                                text=True,
+                                check=True,
+                                timeout=DOCKER_CLI_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return None
+    return json.loads(result.stdout)
+
+def _docker_running():
+    """Check whether the Docker engine responds."""
+    return _docker_info() is not None
+
+def _docker_is_arm():
+    """Check whether Docker runs on ARM as the daemon itself reports it (falls back to the host)."""
+    try:
+        architecture = (_docker_info() or {}).get('Architecture')
+    except _DOCKER_TIMEOUTS:
+        architecture = None
+    if not architecture:
+        return _IS_ARM
+    return architecture in ('aarch64', 'arm64')
+
+def _ports_open(host, ports, deadline_s=2):
+    """Probe several TCP ports at once, returning {port: reachable} within one shared deadline."""
+    # A blocking connect() can outlive settimeout() while the kernel retries SYNs,
+    # so connect non-blocking and bound the wait ourselves with select(). All
+    # probes are in flight together, so the total wait is the slowest port.
+    results = {port: False for port in ports}
+    pending = {}
+    try:
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            result = sock.connect_ex((host, port))
+            if result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                pending[sock] = port
+                continue
+            results[port] = result == 0
+            sock.close()
+        
+        deadline = time.monotonic() + deadline_s
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _, writable, _ = select.select([], list(pending), [], remaining)
+            if not writable:
+                break
+            for sock in writable:
+                port = pending.pop(sock)
+                results[port] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    return results
+
+def _neo4j_http_ready(host, port=7474, attempts=3):
+    """Poll the Neo4j HTTP endpoint until it answers, returning (ready, server_version)."""
+    # The HTTP listener accepts connections before the database can serve queries,
+    # so wait for an actual response rather than trusting an open port.
+    for attempt in range(attempts):
+        conn = http.client.HTTPConnection(host, port, timeout=1)
+        try:
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            body = response.read()
+            if response.status in (200, 302):
+                version = response.getheader('Server')
+                try:
+                    version = json.loads(body).get('neo4j_version', version)
+                except (ValueError, AttributeError):
+                    pass
+                return True, version
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            conn.close()
+        if attempt < attempts - 1:
+            time.sleep(1)
+    return False, None
+
+def _neo4j_auth_none():
+    """Check whether the Neo4j container runs with authentication disabled."""
+    container_env = _neo4j_container_env()
+    return container_env is not None and container_env.get('NEO4J_AUTH') == 'none'
+
+def format_status(component, status, details=None, notes=(), color=True):
+    """Format a status message as report lines."""
     status_color = '\033[92m' if status else '\033[91m'  # Green or Red
     reset_color = '\033[0m'
+    if not color:
+        status_color = reset_color = ''
     status_text = "✓ PASS" if status else "✗ FAIL"
     
-    print(f"{component:30} {status_color}{status_text}{reset_color}")
+    lines = [f"{component:30} {status_color}{status_text}{reset_color}\n"]
+    for note in notes:
+        lines.append(f"  → {note}\n")
     if details and not status:
-        print(f"  → {details}")
+        lines.append(f"  → {details}\n")
     
-    return status
+    return lines
 
 def check_dotenv():
     """Check if .env file exists and is properly configured."""
     env_file = Path('.env')
     if not env_file.exists():
-        return print_status(".env file", False, "File not found. Run 'cp .env.example .env' and edit it.")
-    
-    load_dotenv()
+        return CheckResult(".env file", False, "File not found. Run 'cp .env.example .env' and edit it.")
     
     # Check if Neo4j is running with authentication disabled
-    try:
-        result = subprocess.run(
-            ['docker', 'exec', 'neo4j-local-analyzer', 'env'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False
-        )
-        neo4j_auth_none = 'NEO4J_AUTH=none' in result.stdout
-    except Exception:
-        neo4j_auth_none = False
+    neo4j_auth_none = _neo4j_auth_none()
     
     # If Neo4j is running without authentication, we don't need NEO4J_PASSWORD
     required_vars = [
@@ -58,117 +272,110 @@ def check_dotenv():
     default_values = []
     
     for var in required_vars:
-        value = os.getenv(var)
+        value = env().get(var)
         if not value:
             missing.append(var)
-        elif any(default in value for default in ['YOUR_', 'your-']):
+        elif _DEFAULT_RE.search(value):
             default_values.append(var)
     
     if missing:
-        return print_status("Environment variables", False, 
+        return CheckResult("Environment variables", False, 
                           f"Missing variables: {', '.join(missing)}")
     
     if default_values:
-        return print_status("Environment variables", False, 
+        return CheckResult("Environment variables", False, 
                           f"Default values need to be changed: {', '.join(default_values)}")
     
-    return print_status("Environment variables", True)
+    return CheckResult("Environment variables", True)
 
 def check_oauth_credentials():
-    """Check if OAuth credentials file exists and token pickle if available."""
-    credentials_file = Path('credentials.json')
+    """Check if OAuth credentials file exists and cached token if available."""
+    credentials_file = Path(CREDENTIALS_FILE)
     if not credentials_file.exists():
-        return print_status("OAuth credentials", False, 
+        return CheckResult("OAuth credentials", False, 
                           "credentials.json not found. Download OAuth credentials from Google Cloud Console.")
     
     # Check file format (should be a valid JSON)
     try:
-        with open(credentials_file, 'r') as f:
-            credentials = json.load(f)
+        credentials = load_oauth_client()
         
         # Basic validation of OAuth credentials file
         if 'installed' not in credentials and 'web' not in credentials:
-            return print_status("OAuth credentials", False, 
+            return CheckResult("OAuth credentials", False, 
                               "Invalid OAuth credentials format. Download OAuth credentials from Google Cloud Console.")
         
-        # Look for token.pickle (optional)
-        token_file = Path('token.pickle')
+        # Look for token.json (optional)
+        token_file = Path('token.json')
         if token_file.exists():
-            print("  → OAuth token found (token.pickle). Authentication should be cached.")
+            note = "OAuth token found (token.json). Authentication should be cached."
         else:
-            print("  → No OAuth token found. Browser will open for authentication on first run.")
+            note = "No OAuth token found. Browser will open for authentication on first run."
         
-        return print_status("OAuth credentials", True)
+        return CheckResult("OAuth credentials", True, notes=(note,))
     except json.JSONDecodeError:
-        return print_status("OAuth credentials", False, 
+        return CheckResult("OAuth credentials", False, 
                           "credentials.json is not valid JSON")
     except Exception as e:
-        return print_status("OAuth credentials", False, str(e))
+        return CheckResult("OAuth credentials", False, str(e))
 
 def check_gemini_api_key():
     """Check if Gemini API key is set and valid format."""
-    api_key = os.getenv('GOOGLE_GEMINI_API_KEY')
+    api_key = env().get('GOOGLE_GEMINI_API_KEY')
     
     if not api_key:
-        return print_status("Gemini API key", False, 
+        return CheckResult("Gemini API key", False, 
                           "GOOGLE_GEMINI_API_KEY environment variable not set")
     
-    if 'YOUR_GEMINI_API_KEY_HERE' in api_key:
-        return print_status("Gemini API key", False, 
+    if _DEFAULT_RE.search(api_key):
+        return CheckResult("Gemini API key", False, 
                           "Default value needs to be replaced with a real API key")
     
     # Basic format check (actual validation would require an API call)
     if len(api_key) < 10:
-        return print_status("Gemini API key", False, 
+        return CheckResult("Gemini API key", False, 
                           "API key appears too short to be valid")
     
-    return print_status("Gemini API key", True)
+    return CheckResult("Gemini API key", True)
 
 def check_docker_status():
     """Check if Docker is running and the Neo4j container is available."""
     try:
-        # Try to run docker command to check status
-        subprocess.run(['docker', 'info'], 
-                       stdout=subprocess.DEVNULL, 
-                       stderr=subprocess.DEVNULL, 
-                       check=True)
-        docker_running = True
-    except (subprocess.SubprocessError, FileNotFoundError):
-        docker_running = False
+        docker_running = _docker_running()
+    except _DOCKER_TIMEOUTS:
+        return CheckResult("Docker status", False, DOCKER_HUNG_MSG)
     
     if not docker_running:
-        return print_status("Docker status", False, 
+        return CheckResult("Docker status", False, 
                          "Docker engine is not running or not installed. Please start Docker.")
     
     # Check if we're on ARM architecture
-    is_arm = platform.machine() in ['arm64', 'aarch64']
-    if is_arm:
-        print("  → Running on ARM architecture (Apple Silicon or similar)")
+    notes = []
+    if _docker_is_arm():
+        notes.append("Running on ARM architecture (Apple Silicon or similar)")
     
     # Check if Neo4j container is running
     try:
-        result = subprocess.run(
-            ['docker', 'ps', '--filter', 'name=neo4j-local-analyzer', '--format', '{{.Status}}'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False
-        )
-        
-        if 'Up ' in result.stdout:
-            return print_status("Docker status", True)
+        if _neo4j_container_running():
+            return CheckResult("Docker status", True, notes=notes)
         else:
-            container_cmd = "docker-compose up -d neo4j" if os.path.exists('/usr/local/bin/docker-compose') else "docker compose up -d neo4j"
-            return print_status("Docker status", False, 
-                            f"Neo4j container is not running. Start it with: {container_cmd}")
+            return CheckResult("Docker status", False, 
+                            f"Neo4j container is not running. Start it with: {_COMPOSE_CMD}", notes)
+    except _DOCKER_TIMEOUTS:
+        return CheckResult("Docker status", False, DOCKER_HUNG_MSG, notes)
     except Exception as e:
-        return print_status("Docker status", False, f"Error checking Neo4j container: {e}")
+        return CheckResult("Docker status", False, f"Error checking Neo4j container: {e}")
 
 def check_neo4j_connection():
     """Check if Neo4j is running and accessible."""
-    # First check if Docker and container are running
-    docker_status = check_docker_status()
-    if not docker_status:
-        return False
+    # Docker itself is reported by check_docker_status; only probe once the container is up
+    try:
+        container_up = _docker_running() and _neo4j_container_running()
+    except Exception:
+        container_up = False
+    if not container_up:
+        return CheckResult("Neo4j connection", False, "Neo4j container is not running (see Docker status)")
     
-    host = os.getenv('NEO4J_URI', 'bolt://localhost:7687').replace('bolt://', '')
+    host = env().get('NEO4J_URI', 'bolt://localhost:7687').replace('bolt://', '')
     
     # Extract host and port
     if ':' in host:
@@ -180,77 +387,103 @@ def check_neo4j_connection():
     # Check Neo4j HTTP port first (more likely to be ready before Bolt)
     http_port = 7474
     neo4j_ready = False
+    notes = []
     
     try:
-        # First try HTTP port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)  # 2 seconds timeout
-        http_result = sock.connect_ex((host, http_port))
-        sock.close()
+        # Probe both ports together, then poll the HTTP interface if it is listening
+        open_ports = _ports_open(host, (http_port, port))
+        bolt_open = open_ports[port]
+        http_open, server_version = False, None
+        if open_ports[http_port]:
+            http_open, server_version = _neo4j_http_ready(host, http_port)
         
-        # Then try Bolt port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)  # 2 seconds timeout
-        bolt_result = sock.connect_ex((host, port))
-        sock.close()
-        
-        if http_result == 0 and bolt_result == 0:
+        if http_open and bolt_open:
+            if server_version:
+                notes.append(f"Connected to Neo4j {server_version}")
             # Check if Neo4j container has authentication disabled
-            try:
-                result = subprocess.run(
-                    ['docker', 'exec', 'neo4j-local-analyzer', 'env'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False
-                )
-                
-                if 'NEO4J_AUTH=none' in result.stdout:
-                    print("  → Neo4j is running without authentication (NEO4J_AUTH=none)")
-                    # Update environment variables check to not require NEO4J_PASSWORD
-                    return print_status("Neo4j connection", True)
-            except Exception:
-                pass
+            if _neo4j_auth_none():
+                notes.append("Neo4j is running without authentication (NEO4J_AUTH=none)")
+                return CheckResult("Neo4j connection", True, notes=notes)
                 
             neo4j_ready = True
-        elif http_result == 0 and bolt_result != 0:
-            print("  → Neo4j HTTP interface is accessible, but Bolt port is not ready yet")
-            print("  → This is normal during startup. Try again in 30 seconds")
+        elif http_open and not bolt_open:
+            notes.append("Neo4j HTTP interface is accessible, but Bolt port is not ready yet")
+            notes.append("This is normal during startup. Try again in 30 seconds")
             neo4j_ready = False
-        elif http_result != 0:
-            print("  → Neo4j HTTP interface is not accessible")
+        elif not http_open:
+            notes.append("Neo4j HTTP interface is not responding")
             neo4j_ready = False
             
         if neo4j_ready:
-            return print_status("Neo4j connection", True)
+            return CheckResult("Neo4j connection", True, notes=notes)
         else:
             # Check for common Docker issues
-            is_arm = platform.machine() in ['arm64', 'aarch64']
             docker_info = "If you're on Apple Silicon (M1/M2/M3), make sure docker-compose.yml has platform: linux/amd64 set for Neo4j."
             
             msg = f"Neo4j not fully accessible at {host}:{port} yet. Container might still be starting up or has crashed."
-            if is_arm:
+            if _docker_is_arm():
                 msg += f"\n  → {docker_info}"
-            return print_status("Neo4j connection", False, msg)
+            return CheckResult("Neo4j connection", False, msg, notes)
     except Exception as e:
-        return print_status("Neo4j connection", False, str(e))
+        return CheckResult("Neo4j connection", False, str(e))
+
+CHECKS = [
+    check_dotenv,
+    check_oauth_credentials,
+    check_gemini_api_key,
+    check_docker_status,
+    check_neo4j_connection,
+]
+
+def run_checks():
+    """Run all checks concurrently and return their results in CHECKS order."""
+    results = [None] * len(CHECKS)
+    # The checks are independent and I/O-bound, so overlap their subprocess/socket waits
+    with ThreadPoolExecutor(max_workers=len(CHECKS)) as executor:
+        futures = {executor.submit(check): i for i, check in enumerate(CHECKS)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
 
 def main():
     """Run all checks and report results."""
-    print("\n=== Potion Email Security - Prerequisite Check ===\n")
+    parser = argparse.ArgumentParser(description='Check that all Potion Email Security prerequisites are in place.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON for CI pipelines')
+    parser.add_argument('--no-color', action='store_true',
+                        help='Disable ANSI colors in the text report')
+    args = parser.parse_args()
     
-    checks = [
-        check_dotenv(),
-        check_oauth_credentials(),
-        check_gemini_api_key(),
-        check_neo4j_connection()
-    ]
+    if not args.json:
+        print("\n=== Potion Email Security - Prerequisite Check ===\n", flush=True)
+    
+    results = run_checks()
+    passed = all(result.status for result in results)
     
-    print("\nSummary:")
-    if all(checks):
-        print("\n✅ All prerequisites checks passed! You're ready to run the application.")
-        print("   Run 'python main.py' to start analyzing emails.")
-        return 0
+    if args.json:
+        checks = [
+            {"name": r.component, "ok": bool(r.status), "detail": r.details, "notes": list(r.notes)}
+            for r in results
+        ]
+        json.dump({"ok": passed, "checks": checks}, sys.stdout, ensure_ascii=False)
+        sys.stdout.write("\n")
+        return 0 if passed else 1
+    
+    # Build the whole report first and write it in one go
+    report = []
+    for result in results:
+        report.extend(format_status(*result, color=not args.no_color))
+    
+    report.append("\nSummary:\n")
+    if passed:
+        report.append("\n✅ All prerequisites checks passed! You're ready to run the application.\n")
+        report.append("   Run 'python main.py' to start analyzing emails.\n")
     else:
-        print("\n❌ Some prerequisite checks failed. Please fix the issues above before running the application.")
-        return 1
+        report.append("\n❌ Some prerequisite checks failed. Please fix the issues above before running the application.\n")
+    
+    sys.stdout.write(''.join(report))
+    sys.stdout.flush()
+    return 0 if passed else 1
 
 if __name__ == "__main__":
     sys.exit(main()) 
\ No newline at end of file
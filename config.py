@@ -0,0 +1,28 @@
+"""
+Shared configuration loader for Potion Email Security.
+Parses the .env file and OAuth client secrets once per process.
+"""
+
+import os
+import json
+from pathlib import Path
+from functools import lru_cache
+from types import MappingProxyType
+from dotenv import dotenv_values
+
+CREDENTIALS_FILE = 'credentials.json'
+
+@lru_cache(maxsize=1)
+def env():
+    """Return a read-only mapping of .env values overlaid by the process environment."""
+    # Keys without a value (e.g. a bare `NEO4J_USER`) parse as None; drop them so
+    # lookups behave like os.getenv and an empty .env still caches a valid mapping.
+    values = {k: v for k, v in dotenv_values('.env').items() if v is not None}
+    # Existing environment variables take precedence, matching load_dotenv()
+    values.update(os.environ)
+    return MappingProxyType(values)
+
+@lru_cache(maxsize=1)
+def load_oauth_client():
+    """Return the parsed OAuth client secrets from credentials.json."""
+    return json.loads(Path(CREDENTIALS_FILE).read_text())
@@ -1,29 +1,35 @@
 import os
-import pickle
+from functools import lru_cache
+from pathlib import Path
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from dotenv import load_dotenv
+from config import CREDENTIALS_FILE, env, load_oauth_client
 
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+TOKEN_FILE = 'token.json'
+
+@lru_cache(maxsize=1)
 def get_gmail_service():
-    """Get authenticated Gmail API service using OAuth 2.0 for personal Gmail accounts."""
-    # Load environment variables
-    load_dotenv()
-    
+    """Get authenticated Gmail API service using OAuth 2.0 for personal Gmail accounts.
+
+    The service is built once per process; later calls return the cached instance.
+    """
     # Get target email address from .env
-    target_email = os.getenv('TARGET_GMAIL_ADDRESS')
+    target_email = env().get('TARGET_GMAIL_ADDRESS')
     if not target_email:
         raise ValueError("TARGET_GMAIL_ADDRESS not found in .env file")
     
     print(f"Authenticating Gmail API for user: {target_email}")
     
     creds = None
-    # The file token.pickle stores the user's access and refresh tokens
-    if os.path.exists('token.pickle'):
-        print("Loading cached credentials from token.pickle...")
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
+    creds_updated = False
+    # The file token.json stores the user's access and refresh tokens
+    if os.path.exists(TOKEN_FILE):
+        print(f"Loading cached credentials from {TOKEN_FILE}...")
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
     
     # If no valid credentials available, let the user log in
     if not creds or not creds.valid:
@@ -32,32 +38,34 @@ def get_gmail_service():
             creds.refresh(Request())
         else:
             print("No valid credentials found. Starting OAuth flow...")
-            if not os.path.exists('credentials.json'):
+            if not os.path.exists(CREDENTIALS_FILE):
                 raise FileNotFoundError(
                     "credentials.json not found. Please download OAuth client ID credentials "
                     "from Google Cloud Console and save as 'credentials.json'"
                 )
             
             # Start OAuth flow with the user
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json',
-                ['https://www.googleapis.com/auth/gmail.readonly']
-            )
+            flow = InstalledAppFlow.from_client_config(load_oauth_client(), SCOPES)
             print("A browser window will open. Please authorize the application...")
             creds = flow.run_local_server(port=0)
             print("Authorization successful!")
         
+        creds_updated = True
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-            print("Credentials saved to token.pickle")
+        Path(TOKEN_FILE).write_text(creds.to_json())
+        print(f"Credentials saved to {TOKEN_FILE}")
     
     try:
-        # Build and verify the Gmail service
-        service = build('gmail', 'v1', credentials=creds)
-        # Verify connection with a simple API call
-        profile = service.users().getProfile(userId='me').execute()
-        print(f"Successfully authenticated Gmail API for: {profile['emailAddress']}")
+        # Build and verify the Gmail service. google-api-python-client >= 2.0 ships the
+        # Gmail discovery document, so static discovery avoids fetching it over HTTPS.
+        service = build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=True)
+        # Verify connection with a simple API call only for fresh credentials
+        # (or when POTION_VERIFY_AUTH=1); a valid cached token needs no round-trip
+        if creds_updated or env().get('POTION_VERIFY_AUTH') == '1':
+            profile = service.users().getProfile(userId='me').execute()
+            print(f"Successfully authenticated Gmail API for: {profile['emailAddress']}")
+        else:
+            print(f"Using cached Gmail API credentials for: {target_email}")
         return service
     except HttpError as error:
         print(f"Error connecting to Gmail API: {error}")
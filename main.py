@@ -1,30 +1,74 @@
 import os
-import base64
+import asyncio
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import pybase64  # SIMD-accelerated drop-in for base64
 import email
 from email import policy
+from email.utils import parseaddr
 from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
 import time
-import json  # For parsing Gemini response
+import orjson  # For parsing Gemini response
 import re  # For extracting email addresses
+import hashlib
+from typing import TypedDict
+from pathlib import Path
+from collections import Counter, OrderedDict
 
-from dotenv import load_dotenv
+import diskcache
 from googleapiclient.errors import HttpError
 import google.generativeai as genai
-from neo4j import GraphDatabase  # Import Neo4j driver
+from neo4j import GraphDatabase, unit_of_work  # Import Neo4j driver
 
 # Import the new OAuth-based Gmail service
 from gmail_auth import get_gmail_service
+from config import env
+
+# --- Logging ---
+
+logger = logging.getLogger("potion")
+
+def configure_logging():
+    """Sends log records through a queue so workers never block on terminal writes.
+
+    A background listener thread does the actual I/O. Lines are key=value formatted;
+    set LOG_LEVEL=DEBUG to see the per-email details.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("ts=%(asctime)s level=%(levelname)s %(message)s"))
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))  # Final formatting happens in the listener
+    listener = QueueListener(log_queue, stream_handler)
+    level_name = env().get('LOG_LEVEL', 'INFO').upper()
+    level = logging.getLevelNamesMapping().get(level_name)
+    logging.basicConfig(level=level if level is not None else logging.INFO, handlers=[queue_handler])
+    listener.start()
+    atexit.register(listener.stop)  # Flushes queued records on exit
+    if level is None:
+        logger.warning("event=invalid_log_level value=%r fallback=INFO", level_name)
+
+configure_logging()
 
 # --- Configuration & Authentication ---
 
-load_dotenv()
+GEMINI_API_KEY = env().get('GOOGLE_GEMINI_API_KEY')
+TARGET_USER_EMAIL = env().get('TARGET_GMAIL_ADDRESS')
 
-GEMINI_API_KEY = os.getenv('GOOGLE_GEMINI_API_KEY')
-TARGET_USER_EMAIL = os.getenv('TARGET_GMAIL_ADDRESS')
+NEO4J_URI = env().get('NEO4J_URI')
+NEO4J_USER = env().get('NEO4J_USER')
+NEO4J_PASSWORD = env().get('NEO4J_PASSWORD')
 
-NEO4J_URI = os.getenv('NEO4J_URI')
-NEO4J_USER = os.getenv('NEO4J_USER')
-NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD')
+# Optional Gmail push notifications: when both are set, main() reacts to Pub/Sub
+# notifications from users.watch() instead of polling the inbox
+GMAIL_PUBSUB_TOPIC = env().get('GMAIL_PUBSUB_TOPIC')
+GMAIL_PUBSUB_SUBSCRIPTION = env().get('GMAIL_PUBSUB_SUBSCRIPTION')
+GOOGLE_SERVICE_ACCOUNT_FILE = env().get('GOOGLE_SERVICE_ACCOUNT_FILE')
+GMAIL_WATCH_RENEW_INTERVAL = 24 * 60 * 60  # seconds; Gmail expires watches after 7 days
+GMAIL_WATCH_RETRY_DELAY = 5 * 60  # seconds; wait before retrying a failed renewal
 
 # Configure Gemini Client
 if not GEMINI_API_KEY:
@@ -32,112 +76,324 @@ if not GEMINI_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 gemini_model = genai.GenerativeModel('gemini-1.5-flash-latest')
 
+class GeminiAnalysis(TypedDict):
+    """Response schema enforced on Gemini so it returns bare JSON with these keys."""
+    intent: str
+    urgency_score: int
+    manipulation_score: int
+    impersonation_likelihood: str
+    risk_level: str
+    explanation: str
+
+GEMINI_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": GeminiAnalysis,
+}
+
+# Static prompt text is built once; analyze_with_gemini only fills in the per-email fields.
+# Literal braces are doubled for str.format.
+_PROMPT_TMPL = """
+Analyze the following email content for potential social engineering risks like phishing, BEC, or scams. Consider the provided communication history context. Provide output ONLY in valid JSON format with the specified keys.
+
+**Communication Context:**
+*   Sender has sent emails to recipient before: {history_exists}
+*   Number of previous emails sent by sender to recipient: {communication_count}
+
+**Email Details:**
+Email Subject: {subject}
+Sender: {sender}
+Email Body:
+---
+{body}
+---
+
+Analysis Tasks (respond in JSON):
+{{
+  "intent": "Classify primary intent. Choose one: [Payment Request, Credential Request, Urgent Action Required, Information Request, Gift Card Request, Job Offer Scam, Impersonation Attempt, Marketing, Personal Communication, Spam, Other].",
+  "urgency_score": "Rate perceived urgency (1=Low, 5=High).",
+  "manipulation_score": "Rate likelihood of manipulative language (1=Low, 5=High).",
+  "impersonation_likelihood": "Rate likelihood this is an impersonation attempt (Low, Medium, High), considering sender address and communication history context.",
+  "risk_level": "Overall textual risk level (Low, Medium, High), considering communication context and content.",
+  "explanation": "BRIEF (1-2 sentences) explanation for the risk level, mentioning key indicators and context if relevant (e.g., 'High risk payment request from first-time sender')."
+}}
+"""
+
+# Connection pool sized for this script rather than the driver defaults (100 connections,
+# 1h lifetime). Keep max_connection_pool_size >= the number of concurrent graph workers.
+NEO4J_DRIVER_OPTIONS = {
+    "max_connection_pool_size": 16,
+    "connection_acquisition_timeout": 10,  # seconds
+    "max_connection_lifetime": 600,  # seconds
+    "keep_alive": True,
+}
+
 # Configure Neo4j Driver (Global instance - manage connections carefully in real apps)
 if not NEO4J_URI:
     raise ValueError("Neo4j URI not found in .env file")
 try:
-    print(f"Connecting to Neo4j at {NEO4J_URI}...")
+    logger.info("event=neo4j_connecting uri=%s", NEO4J_URI)
     # Check if authentication is needed
     if NEO4J_USER and NEO4J_PASSWORD:
-        print(f"Using authentication with user: {NEO4J_USER}")
-        neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+        logger.info("event=neo4j_auth mode=basic user=%s", NEO4J_USER)
+        neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), **NEO4J_DRIVER_OPTIONS)
     else:
-        print("Connecting without authentication (NEO4J_AUTH=none)")
-        neo4j_driver = GraphDatabase.driver(NEO4J_URI)
+        logger.info("event=neo4j_auth mode=none")
+        neo4j_driver = GraphDatabase.driver(NEO4J_URI, **NEO4J_DRIVER_OPTIONS)
     
     neo4j_driver.verify_connectivity()  # Check connection on startup
-    print("Successfully connected to Neo4j.")
+    logger.info("event=neo4j_connected uri=%s", NEO4J_URI)
 except Exception as e:
-    print(f"Error connecting to Neo4j: {e}. Make sure Neo4j is running via Docker.")
-    print(f"Current Neo4j URI: {NEO4J_URI}")
-    print("Try these troubleshooting steps:")
-    print("1. Make sure the Neo4j container is running: docker ps | grep neo4j")
-    print("2. Check docker-compose.yml - NEO4J_AUTH should be set to 'none'")
-    print("3. Restart the Neo4j container: docker-compose down && docker-compose up -d")
+    logger.error(
+        "event=neo4j_connect_failed uri=%s error=%r hint=%r", NEO4J_URI, str(e),
+        "make sure the container is running (docker ps | grep neo4j) with NEO4J_AUTH=none "
+        "in docker-compose.yml; restart it with docker-compose down && docker-compose up -d"
+    )
     neo4j_driver = None  # Set driver to None if connection fails
 
+# Bounded quantifiers keep long display-name headers from backtracking badly
+_EMAIL_RE = re.compile(r'[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,255}\.[A-Za-z]{2,24}')
+
+# SPF/DKIM/DMARC verdicts in an Authentication-Results header
+_AUTH_RE = re.compile(r'(spf|dkim|dmarc)=(pass|fail)')
+
+# Maximum number of calls Gmail accepts in a single batch request
+GMAIL_BATCH_LIMIT = 100
+
+# Maximum page size of messages.list
+GMAIL_LIST_LIMIT = 500
+
+# Caps on decoded body size; HTML gets more room since markup is stripped afterwards
+MAX_PLAIN_BODY_BYTES = 32 * 1024
+MAX_HTML_BODY_BYTES = 256 * 1024
+
+# Headers requested in the metadata-only fetch; parse_email needs nothing else
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date', 'Authentication-Results', 'Reply-To', 'Return-Path']
+PARSED_HEADERS = tuple(name.lower() for name in METADATA_HEADERS)
+
+# Maximum number of Gemini requests in flight at once (tune to the API quota)
+GEMINI_CONCURRENCY = 8
+
+# On-disk cache of Gemini analyses so repeated content (threads, newsletters) skips the LLM
+GEMINI_CACHE_DIR = '.gemini_cache'
+GEMINI_CACHE_TTL = 24 * 60 * 60  # seconds
+_gemini_cache = diskcache.Cache(GEMINI_CACHE_DIR)
+
+# IDs of emails already analyzed, so later batches and runs don't redo them
+PROCESSED_IDS_FILE = '.processed_ids'
+
+# Times watch mode tries an email before giving up on it (e.g. deleted before the fetch)
+MAX_EMAIL_ATTEMPTS = 3
+
 # --- Email Parsing Helper ---
 def extract_email_address(header_string):
     """Extracts the first email address found in a header string."""
     if not header_string:
         return None
-    # Simple regex to find email patterns
-    match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', header_string)
+    # Handles '"Name" <a@b>' and bare addresses; unbracketed malformed headers come back
+    # whole (display name included), so only accept a result that is just an address
+    address = parseaddr(header_string)[1]
+    if _EMAIL_RE.fullmatch(address):
+        return address.lower()
+    # Fall back to scanning malformed headers for anything address-shaped
+    match = _EMAIL_RE.search(header_string)
     return match.group(0).lower() if match else None
 
+def html_to_text(body_html):
+    """Converts an HTML body to plain text using the C-backed selectolax parser."""
+    try:
+        return HTMLParser(body_html).text(separator='\n').strip()
+    except Exception:
+        # Fall back to the slower but more forgiving BeautifulSoup parser
+        soup = BeautifulSoup(body_html, 'html.parser')
+        return soup.get_text(separator='\n').strip()
+
 # --- Email Processing ---
-def fetch_unread_emails(service, max_results=5):
-    """Fetch unread emails from the Gmail inbox."""
+def fetch_unread_emails(service, max_results=5, skip_ids=()):
+    """Fetch up to max_results unread emails from the Gmail inbox, leaving out skip_ids.
+
+    Pages through the listing until enough IDs are found, so IDs that were already
+    handled don't use up the window.
+    """
+    msg_ids = []
+    page_token = None
+    # Over-fetch by the number of IDs that may be skipped; usually one page is enough
+    page_size = min(max_results + len(skip_ids), GMAIL_LIST_LIMIT)
     try:
-        results = service.users().messages().list(
-            userId=TARGET_USER_EMAIL,
-            labelIds=['INBOX', 'UNREAD'],
-            maxResults=max_results
-        ).execute()
-        messages = results.get('messages', [])
-        print(f"Found {len(messages)} unread emails.")
-        return [msg['id'] for msg in messages]
+        while len(msg_ids) < max_results:
+            results = service.users().messages().list(
+                userId=TARGET_USER_EMAIL,
+                labelIds=['INBOX', 'UNREAD'],
+                maxResults=page_size,
+                pageToken=page_token
+            ).execute()
+            for msg in results.get('messages', []):
+                if msg['id'] not in skip_ids:
+                    msg_ids.append(msg['id'])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
     except HttpError as error:
-        print(f"An error occurred fetching messages: {error}")
-        return []
-
-def get_email_details(service, msg_id):
-    """Get the full details of an email by ID."""
+        logger.error("event=fetch_unread_failed error=%r", str(error))
+    logger.info("event=fetch_unread count=%d", len(msg_ids[:max_results]))
+    return msg_ids[:max_results]
+
+def start_inbox_watch(service):
+    """Asks Gmail to publish INBOX changes to the Pub/Sub topic and returns the watch response."""
+    response = service.users().watch(
+        userId=TARGET_USER_EMAIL,
+        body={'topicName': GMAIL_PUBSUB_TOPIC, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+    ).execute()
+    logger.info("event=watch_started topic=%s history_id=%s", GMAIL_PUBSUB_TOPIC, response['historyId'])
+    return response
+
+def renew_inbox_watch(service):
+    """Renews the inbox watch, returning the new history ID or None if Gmail refused."""
     try:
-        message = service.users().messages().get(
-            userId=TARGET_USER_EMAIL,
-            id=msg_id,
-            format='full'
-        ).execute()
-        return message
+        return start_inbox_watch(service)['historyId']
     except HttpError as error:
-        print(f"An error occurred fetching email details (ID: {msg_id}): {error}")
+        logger.error("event=watch_renew_failed error=%r retry_in=%d", str(error), GMAIL_WATCH_RETRY_DELAY)
         return None
 
+class HistoryExpiredError(Exception):
+    """Gmail no longer keeps history this far back (e.g. after downtime); resync required."""
+
+def fetch_new_message_ids(service, start_history_id):
+    """Lists messages added to the INBOX since a history ID.
+
+    Returns (message_ids, latest_history_id) so the next call can continue from there.
+    Raises HistoryExpiredError when Gmail no longer has the starting history ID.
+    """
+    msg_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId=TARGET_USER_EMAIL,
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                labelId='INBOX',
+                pageToken=page_token
+            ).execute()
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_ids.append(added['message']['id'])
+            latest_history_id = response.get('historyId', latest_history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+    except HttpError as error:
+        if error.resp.status == 404:
+            raise HistoryExpiredError(start_history_id) from error
+        logger.error("event=fetch_history_failed error=%r", str(error))
+    logger.info("event=fetch_new count=%d", len(msg_ids))
+    return list(dict.fromkeys(msg_ids)), latest_history_id
+
+def get_email_details_batch(service, msg_ids, full=False):
+    """Get several emails in batched requests, keyed by message ID.
+
+    By default only headers and metadata are fetched; pass full=True to include the body.
+    """
+    messages = {}
+
+    def store_message(request_id, response, exception):
+        if exception is not None:
+            logger.error("event=fetch_details_failed msg_id=%s error=%r", request_id, str(exception))
+        else:
+            messages[request_id] = response
+
+    if full:
+        params = {'format': 'full'}
+    else:
+        params = {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS}
+
+    # Gmail accepts at most GMAIL_BATCH_LIMIT calls per batch request
+    for start in range(0, len(msg_ids), GMAIL_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=store_message)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_LIMIT]:
+            batch.add(
+                service.users().messages().get(userId=TARGET_USER_EMAIL, id=msg_id, **params),
+                request_id=msg_id
+            )
+        try:
+            batch.execute()
+        except HttpError as error:
+            logger.error("event=fetch_batch_failed error=%r", str(error))
+    return messages
+
+def decode_body_parts(parts, max_bytes=MAX_PLAIN_BODY_BYTES):
+    """Decodes base64url-encoded body parts into a single newline-joined string.
+
+    Output is capped at roughly max_bytes: encoded data past the limit is never decoded,
+    so oversized messages (e.g. inline images in HTML newsletters) cost bounded work.
+    """
+    chunks = []
+    remaining = max_bytes
+    for data in parts:
+        if remaining <= 0:
+            break
+        # Every 4 encoded characters carry 3 bytes; cutting on that boundary keeps the prefix decodable
+        encoded_limit = -(-remaining // 3) * 4
+        chunk = pybase64.urlsafe_b64decode(data[:encoded_limit])
+        chunks.append(chunk)
+        remaining -= len(chunk) + 1
+    return b"\n".join(chunks).decode('utf-8', errors='replace')
+
 def parse_email(message):
     """Parse the email message into a structured format."""
     details = {'id': message['id'], 'headers': {}, 'body': '', 'sender': None, 'recipient': TARGET_USER_EMAIL}  # Recipient is our target user
     payload = message.get('payload', {})
     headers = payload.get('headers', [])
 
-    for header in headers:
-        name = header.get('name').lower()
-        value = header.get('value')
-        if name in ['from', 'to', 'subject', 'date', 'reply-to', 'return-path', 'authentication-results']:
-            details['headers'][name] = value
-            if name == 'from':
-                details['sender'] = extract_email_address(value)  # Extract sender email
+    # One pass to index the headers by lowercase name (last occurrence wins, as before)
+    header_map = {header.get('name', '').lower(): header.get('value', '') for header in headers}
+    for name in PARSED_HEADERS:
+        if name in header_map:
+            details['headers'][name] = header_map[name]
+    details['sender'] = extract_email_address(header_map.get('from'))  # Extract sender email
+
+    details['body'] = extract_body(payload)
 
-    # Body extraction logic
+    if not details['sender']:
+        logger.warning("event=sender_missing msg_id=%s", details['id'])
+
+    return details
+
+def extract_body(payload):
+    """Extracts the text body from a message payload (empty for metadata-only messages).
+
+    The body is best-effort truncated (see MAX_PLAIN_BODY_BYTES / MAX_HTML_BODY_BYTES);
+    Gemini only sees the first 4000 characters anyway.
+    """
+    body = ''
     if 'parts' in payload:
-        parts = payload['parts']
-        body_plain = ''
-        body_html = ''
-        for part in parts:
-            mime_type = part.get('mimeType')
+        # Collect the still-encoded parts first so only the ones we use get decoded
+        plain_parts = []
+        html_parts = []
+        for part in payload['parts']:
             body_data = part.get('body', {}).get('data')
-            if body_data:
-                decoded_data = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
-                if mime_type == 'text/plain':
-                    body_plain += decoded_data + "\n"
-                elif mime_type == 'text/html':
-                    body_html += decoded_data + "\n"
-        if body_plain.strip():
-            details['body'] = body_plain.strip()
-        elif body_html.strip():
-            soup = BeautifulSoup(body_html, 'html.parser')
-            details['body'] = soup.get_text(separator='\n').strip()
+            if not body_data:
+                continue
+            mime_type = part.get('mimeType')
+            if mime_type == 'text/plain':
+                plain_parts.append(body_data)
+            elif mime_type == 'text/html':
+                html_parts.append(body_data)
+
+        body_plain = decode_body_parts(plain_parts).strip()
+        if body_plain:
+            body = body_plain
         else:
-             details['body'] = "Could not extract plain/HTML body from parts."
+            # Only decode HTML when there is no usable plain-text alternative
+            body_html = decode_body_parts(html_parts, MAX_HTML_BODY_BYTES)
+            if body_html.strip():
+                body = html_to_text(body_html)
+            else:
+                body = "Could not extract plain/HTML body from parts."
     elif 'body' in payload and payload['body'].get('data'):
          body_data = payload['body'].get('data')
-         decoded_data = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='replace')
-         details['body'] = decoded_data.strip()
-
-    if not details['sender']:
-        print(f"  Warning: Could not extract sender email address for message {details['id']}")
-
-    return details
+         body = decode_body_parts([body_data]).strip()
+    return body
 
 def mark_email_as_read(service, msg_id):
     """Mark an email as read by removing the UNREAD label."""
@@ -147,166 +403,251 @@ def mark_email_as_read(service, msg_id):
             id=msg_id,
             body={'removeLabelIds': ['UNREAD']}
         ).execute()
-        print(f"  Email {msg_id} marked as read.")
+        logger.debug("event=marked_read msg_id=%s", msg_id)
     except HttpError as error:
-        print(f"  Error marking email as read: {error}")
+        logger.error("event=mark_read_failed msg_id=%s error=%r", msg_id, str(error))
 
 # --- Graph Database Interaction ---
 
-def get_communication_context(driver, sender_email, recipient_email):
-    """Queries Neo4j for historical communication context between sender and recipient."""
-    if not driver or not sender_email or not recipient_email:
-        return {"error": "Missing driver or email addresses"}
-
-    query = """
-    MATCH (sender:EmailAddress {address: $sender_addr})
-    MATCH (recipient:EmailAddress {address: $recipient_addr})
-    OPTIONAL MATCH (sender)-[r:SENT_EMAIL]->(recipient) // Communication from sender to recipient
-    RETURN
-        exists((sender)-[:SENT_EMAIL]->(recipient)) AS sent_to_recipient_before,
-        count(r) AS emails_sent_to_recipient,
-        datetime() AS query_time // Example placeholder data
-    """
-    parameters = {"sender_addr": sender_email, "recipient_addr": recipient_email}
-    context = {
-        "history_exists": False,
-        "communication_count": 0,
-        "error": None
-    }
+def ensure_schema(driver):
+    """Creates the constraint and index the graph queries rely on, if missing."""
+    # The unique constraint backs EmailAddress lookups with an index and keeps
+    # concurrent MERGEs from creating duplicate address nodes.
     try:
-        with driver.session(database="neo4j") as session:  # Use default database 'neo4j'
-             result = session.run(query, parameters)
-             record = result.single()
-             if record:
-                 context["history_exists"] = record["sent_to_recipient_before"]
-                 context["communication_count"] = record["emails_sent_to_recipient"]
-             else:  # Should ideally return even if no match, check logic
-                 print("No communication context record returned from Neo4j.")
-
+        with driver.session(database="neo4j") as session:
+            session.run(
+                "CREATE CONSTRAINT email_addr_unique IF NOT EXISTS "
+                "FOR (e:EmailAddress) REQUIRE e.address IS UNIQUE"
+            ).consume()
+            session.run(
+                "CREATE INDEX sent_email_msgid IF NOT EXISTS "
+                "FOR ()-[r:SENT_EMAIL]-() ON (r.messageId)"
+            ).consume()
+        logger.info("event=neo4j_schema_ready constraint=email_addr_unique index=sent_email_msgid")
     except Exception as e:
-        print(f"  Neo4j Query Error: {e}")
-        context["error"] = str(e)
+        logger.warning("event=neo4j_schema_failed error=%r", str(e))
+
+# Maximum number of sender/recipient contexts kept between polling cycles
+CONTEXT_CACHE_SIZE = 4096
+
+# LRU cache of (sender, recipient) -> (history_exists, communication_count).
+# Writes refresh a pair's entry with the count they return; failed writes drop it.
+_context_cache = OrderedDict()
+_context_cache_stats = {"hits": 0, "misses": 0}
+
+def context_cache_info():
+    """Returns hit/miss statistics for the communication context cache."""
+    return {**_context_cache_stats, "size": len(_context_cache), "maxsize": CONTEXT_CACHE_SIZE}
+
+def _remember_communication_context(pair, history_exists, count):
+    """Stores the communication context of a sender/recipient pair, evicting the oldest entry if full."""
+    _context_cache[pair] = (history_exists, count)
+    _context_cache.move_to_end(pair)
+    if len(_context_cache) > CONTEXT_CACHE_SIZE:
+        _context_cache.popitem(last=False)
+
+def invalidate_communication_context(sender_email, recipient_email):
+    """Drops the cached communication context for a sender/recipient pair."""
+    _context_cache.pop((sender_email, recipient_email), None)
+
+_CONTEXT_QUERY = """
+UNWIND $pairs AS pair
+// Communication from sender to recipient; one pattern evaluation, still a row per pair
+OPTIONAL MATCH (:EmailAddress {address: pair.sender})-[r:SENT_EMAIL]->(:EmailAddress {address: pair.recipient})
+RETURN
+    pair.sender AS sender_addr,
+    pair.recipient AS recipient_addr,
+    count(r) AS emails_sent_to_recipient
+"""
 
-    print(f"  Graph Context: History Exists={context['history_exists']}, Count={context['communication_count']}")
-    return context
+_ADD_COMMUNICATIONS_QUERY = """
+UNWIND $rows AS row
+// Ensure sender and recipient nodes exist
+MERGE (sender:EmailAddress {address: row.sender})
+MERGE (recipient:EmailAddress {address: row.recipient})
+// Count earlier emails before adding this one; the caller refreshes its context cache from it
+WITH row, sender, recipient
+OPTIONAL MATCH (sender)-[prior:SENT_EMAIL]->(recipient)
+WITH row, sender, recipient, count(prior) AS prior_count
+// Create the relationship representing the email sent
+CREATE (sender)-[r:SENT_EMAIL {
+    messageId: row.msg_id,
+    timestamp: datetime({epochMillis: row.ts_ms}), // Store as Neo4j datetime
+    riskLevel: row.risk_lvl
+}]->(recipient)
+RETURN row.msg_id AS msg_id,
+    id(r) AS rel_id, // ID of the created relationship
+    prior_count > 0 AS history_exists,
+    prior_count AS communication_count
+"""
 
-def add_communication_to_graph(driver, sender_email, recipient_email, message_id, timestamp_ms, risk_level):
-    """Adds the current email communication to the Neo4j graph."""
-    if not driver or not sender_email or not recipient_email:
-        print("  Skipping graph update: Missing driver or email addresses.")
-        return
+# Transaction functions for session.execute_read/execute_write, which retry transient
+# failures. The query text is constant and parameterized so Neo4j reuses its cached
+# plans; the metadata tags each transaction for server-side query logs.
+@unit_of_work(metadata={"app": "potion", "op": "get_ctx"})
+def _read_contexts(tx, pairs):
+    return list(tx.run(_CONTEXT_QUERY, pairs=pairs))
+
+@unit_of_work(metadata={"app": "potion", "op": "add_communications"})
+def _write_communications(tx, rows):
+    return list(tx.run(_ADD_COMMUNICATIONS_QUERY, rows=rows))
 
-    query = """
-    // Ensure sender node exists
-    MERGE (sender:EmailAddress {address: $sender_addr})
-    // Ensure recipient node exists
-    MERGE (recipient:EmailAddress {address: $recipient_addr})
-    // Create the relationship representing the email sent
-    CREATE (sender)-[r:SENT_EMAIL {
-        messageId: $msg_id,
-        timestamp: datetime({epochMillis: $ts_ms}), // Store as Neo4j datetime
-        riskLevel: $risk_lvl
-    }]->(recipient)
-    RETURN id(r) // Return ID of the created relationship
+def get_communication_contexts(session, pairs):
+    """Queries Neo4j for historical communication context of several sender/recipient pairs.
+
+    Returns a dict keyed by (sender, recipient). Cached pairs are served from memory;
+    the rest are fetched together with a single UNWIND query.
+    """
+    contexts = {}
+    missing = []
+    for pair in dict.fromkeys(pairs):  # De-duplicate while keeping order
+        if pair in _context_cache:
+            _context_cache.move_to_end(pair)
+            _context_cache_stats["hits"] += 1
+            history_exists, count = _context_cache[pair]
+            contexts[pair] = {"history_exists": history_exists, "communication_count": count, "error": None}
+        else:
+            _context_cache_stats["misses"] += 1
+            missing.append(pair)
+
+    if missing:
+        pair_params = [{"sender": sender, "recipient": recipient} for sender, recipient in missing]
+        try:
+            for record in session.execute_read(_read_contexts, pair_params):
+                pair = (record["sender_addr"], record["recipient_addr"])
+                count = record["emails_sent_to_recipient"]
+                history_exists = count > 0
+                contexts[pair] = {"history_exists": history_exists, "communication_count": count, "error": None}
+                _remember_communication_context(pair, history_exists, count)
+        except Exception as e:
+            logger.error("event=graph_query_failed pairs=%d error=%r", len(missing), str(e))
+            for pair in missing:
+                contexts[pair] = {"history_exists": False, "communication_count": 0, "error": str(e)}
+
+    for (sender, _), context in contexts.items():
+        logger.debug("event=graph_context sender=%s history_exists=%s count=%s",
+                     sender, context['history_exists'], context['communication_count'])
+    return contexts
+
+def add_communications_to_graph(session, rows):
+    """Adds a batch of email communications to the Neo4j graph in one statement.
+
+    Each row is a dict with sender, recipient, msg_id, ts_ms and risk_lvl. Returns a dict
+    keyed by message ID with the sender/recipient history as it was before the batch,
+    read in the same write transaction. The same counts refresh the context cache, so
+    the next batch doesn't have to query these pairs again.
     """
-    parameters = {
-        "sender_addr": sender_email,
-        "recipient_addr": recipient_email,
-        "msg_id": message_id,
-        "ts_ms": int(timestamp_ms),  # Gmail provides timestamp in ms epoch
-        "risk_lvl": risk_level
-    }
+    if not rows:
+        return {}
+
     try:
-        with driver.session(database="neo4j") as session:
-             result = session.run(query, parameters)
-             record = result.single()
-             if record:
-                 print(f"  Graph Update: Added SENT_EMAIL relationship (ID: {record[0]})")
-             else:
-                 print("  Graph Update: Relationship creation did not return an ID.")  # Should not happen if successful
+        records = session.execute_write(_write_communications, rows)
     except Exception as e:
-        print(f"  Neo4j Update Error: {e}")
+        logger.error("event=graph_update_failed rows=%d error=%r", len(rows), str(e))
+        for row in rows:
+            invalidate_communication_context(row["sender"], row["recipient"])
+        return {}
+
+    pairs = {row["msg_id"]: (row["sender"], row["recipient"]) for row in rows}
+    rows_per_pair = Counter(pairs.values())
+    prior_counts = {}
+    write_contexts = {}
+    for record in records:
+        logger.debug("event=graph_update msg_id=%s rel_id=%s prior_emails=%s",
+                     record['msg_id'], record['rel_id'], record['communication_count'])
+        pair = pairs[record["msg_id"]]
+        prior_counts[pair] = min(prior_counts.get(pair, record["communication_count"]), record["communication_count"])
+        write_contexts[record["msg_id"]] = {
+            "history_exists": record["history_exists"],
+            "communication_count": record["communication_count"],
+            "error": None
+        }
+
+    # count(prior) is aggregated before any CREATE runs, so every row of a pair reports
+    # the pre-batch count; the pair now has one more email per row on top of that
+    for pair, prior_count in prior_counts.items():
+        _remember_communication_context(pair, True, prior_count + rows_per_pair[pair])
+    return write_contexts
 
 # --- Analysis Modules ---
 
 def perform_traditional_checks(parsed_email):
     """Perform traditional security checks like SPF, DKIM, DMARC."""
-    results = {}
+    results = {'spf': 'neutral/none', 'dkim': 'neutral/none', 'dmarc': 'neutral/none'}
     headers = parsed_email.get('headers', {})
     auth_results = headers.get('authentication-results', '')
-    results['spf'] = 'pass' if 'spf=pass' in auth_results else ('fail' if 'spf=fail' in auth_results else 'neutral/none')
-    results['dkim'] = 'pass' if 'dkim=pass' in auth_results else ('fail' if 'dkim=fail' in auth_results else 'neutral/none')
-    results['dmarc'] = 'pass' if 'dmarc=pass' in auth_results else ('fail' if 'dmarc=fail' in auth_results else 'neutral/none')
-    print(f"  Traditional Checks: SPF={results['spf']}, DKIM={results['dkim']}, DMARC={results['dmarc']}")
+    # Single scan over the header; a pass anywhere wins over a fail, as before
+    for mechanism, verdict in _AUTH_RE.findall(auth_results):
+        if results[mechanism] != 'pass':
+            results[mechanism] = verdict
+    logger.debug("event=traditional_checks spf=%s dkim=%s dmarc=%s", results['spf'], results['dkim'], results['dmarc'])
     return results
 
-def analyze_with_gemini(parsed_email, graph_context):
-    """Analyzes email content using Google Gemini, incorporating graph context."""
+async def analyze_with_gemini(parsed_email, graph_context):
+    """Analyzes email content using Google Gemini, incorporating graph context.
+
+    Failures that may succeed on a later run (API errors, malformed responses) are
+    flagged with 'retryable': True so the email isn't recorded as analyzed.
+    """
     subject = parsed_email.get('headers', {}).get('subject', 'No Subject')
     sender = parsed_email.get('sender', 'Unknown Sender')  # Use extracted sender
     body = parsed_email.get('body', '')
 
     if not body:
-        print("  Gemini Analysis: Skipping - Empty email body.")
+        logger.debug("event=gemini_skipped reason=empty_body sender=%s", sender)
         return {'error': 'Empty body'}
 
-    # Enhanced prompt with communication context
-    prompt = f"""
-Analyze the following email content for potential social engineering risks like phishing, BEC, or scams. Consider the provided communication history context. Provide output ONLY in valid JSON format with the specified keys.
+    # Same content and same history answer the same way; include the context so it busts the key
+    cache_key = hashlib.sha256(
+        f"{sender}|{subject}|{body[:4000]}|{graph_context.get('history_exists')}".encode('utf-8')
+    ).hexdigest()
+    cached_json = _gemini_cache.get(cache_key)
+    if cached_json is not None:
+        cached_analysis = orjson.loads(cached_json)
+        logger.debug("event=gemini_analysis cached=true risk=%s intent=%r",
+                     cached_analysis.get('risk_level', 'N/A'), cached_analysis.get('intent', 'N/A'))
+        return cached_analysis
 
-**Communication Context:**
-*   Sender has sent emails to recipient before: {graph_context.get('history_exists', 'Unknown')}
-*   Number of previous emails sent by sender to recipient: {graph_context.get('communication_count', 'Unknown')}
-
-**Email Details:**
-Email Subject: {subject}
-Sender: {sender}
-Email Body:
----
-{body[:4000]}
----
-
-Analysis Tasks (respond in JSON):
-{{
-  "intent": "Classify primary intent. Choose one: [Payment Request, Credential Request, Urgent Action Required, Information Request, Gift Card Request, Job Offer Scam, Impersonation Attempt, Marketing, Personal Communication, Spam, Other].",
-  "urgency_score": "Rate perceived urgency (1=Low, 5=High).",
-  "manipulation_score": "Rate likelihood of manipulative language (1=Low, 5=High).",
-  "impersonation_likelihood": "Rate likelihood this is an impersonation attempt (Low, Medium, High), considering sender address and communication history context.",
-  "risk_level": "Overall textual risk level (Low, Medium, High), considering communication context and content.",
-  "explanation": "BRIEF (1-2 sentences) explanation for the risk level, mentioning key indicators and context if relevant (e.g., 'High risk payment request from first-time sender')."
-}}
-"""
+    # Enhanced prompt with communication context
+    prompt = _PROMPT_TMPL.format(
+        history_exists=graph_context.get('history_exists', 'Unknown'),
+        communication_count=graph_context.get('communication_count', 'Unknown'),
+        subject=subject,
+        sender=sender,
+        body=body[:4000],
+    )
 
     try:
-        print("  Calling Gemini API (with graph context)...")
-        response = gemini_model.generate_content(prompt)
-        
-        # Parse the JSON response
-        json_response_text = response.text.strip().replace('```json', '').replace('```', '').strip()
-        if '{' in json_response_text and '}' in json_response_text:
-             start = json_response_text.find('{')
-             end = json_response_text.rfind('}') + 1
-             potential_json = json_response_text[start:end]
-             try:
-                 analysis = json.loads(potential_json)
-                 print(f"  Gemini Analysis Received: Risk={analysis.get('risk_level', 'N/A')}, Intent={analysis.get('intent', 'N/A')}")
-                 return analysis
-             except json.JSONDecodeError as json_e:
-                 print(f"  Gemini Analysis: Failed to parse JSON response - {json_e}")
-                 return {'error': 'Failed to parse JSON response', 'raw_response': response.text}
-        else:
-             print("  Gemini Analysis: Response does not appear to contain valid JSON.")
-             return {'error': 'Invalid JSON response format', 'raw_response': response.text}
+        logger.debug("event=gemini_call sender=%s", sender)
+        response = await gemini_model.generate_content_async(
+            prompt, generation_config=GEMINI_GENERATION_CONFIG
+        )
+
+        # Structured output mode returns the JSON object as-is (no markdown fences)
+        try:
+            analysis = orjson.loads(response.text)
+        except orjson.JSONDecodeError as json_e:
+            logger.warning("event=gemini_bad_json error=%r", str(json_e))
+            return {'error': 'Failed to parse JSON response', 'raw_response': response.text, 'retryable': True}
+        if not isinstance(analysis, dict):
+            logger.warning("event=gemini_bad_json error='not a JSON object'")
+            return {'error': 'Invalid JSON response format', 'raw_response': response.text, 'retryable': True}
+
+        logger.debug("event=gemini_analysis cached=false risk=%s intent=%r",
+                     analysis.get('risk_level', 'N/A'), analysis.get('intent', 'N/A'))
+        # Only successes are cached; stored as JSON bytes, which diskcache keeps as-is instead of pickling
+        _gemini_cache.set(cache_key, orjson.dumps(analysis), expire=GEMINI_CACHE_TTL)
+        return analysis
 
     except Exception as e:
-        print(f"  An error occurred calling Gemini API: {e}")
+        logger.error("event=gemini_call_failed error=%r", str(e))
         # Check for safety feedback
         try:
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
                  return {'error': f'Blocked by API safety settings: {response.prompt_feedback.block_reason}'}
         except Exception:
             pass
-        return {'error': f'Gemini API call failed: {e}'}
+        return {'error': f'Gemini API call failed: {e}', 'retryable': True}
 
 # --- Risk Scoring ---
 
@@ -354,100 +695,287 @@ def calculate_risk_score(traditional_results, gemini_results, graph_context):
     elif score >= 30:
         final_risk = "High"
 
-    print(f"  Calculated Score: {score}, Final Risk: {final_risk}")
+    logger.debug("event=risk_score score=%d risk=%s", score, final_risk)
     return final_risk, score, reasons
 
 # --- Main Execution ---
 
-def main():
-    print("Starting Local Gmail Analyzer with Neo4j...")
-    if not neo4j_driver:
-        print("Cannot start without Neo4j connection. Exiting.")
-        return
-
-    gmail_service = get_gmail_service()
-    if not gmail_service:
-        return
-
-    processed_count = 0
-    max_to_process = 5
-
-    try:  # Wrap main loop to ensure driver closes
-        while processed_count < max_to_process:
-            print("\nFetching unread emails...")
-            unread_ids = fetch_unread_emails(gmail_service, max_results=max_to_process - processed_count)
-
-            if not unread_ids:
-                print("No more unread emails found.")
-                break
+def load_processed_ids():
+    """Load the IDs of emails analyzed in earlier batches."""
+    path = Path(PROCESSED_IDS_FILE)
+    if not path.exists():
+        return set()
+    return set(path.read_text().split())
 
-            for msg_id in unread_ids:
-                if processed_count >= max_to_process:
-                    break
+def checkpoint_processed_ids(msg_ids):
+    """Append analyzed email IDs to the checkpoint file."""
+    with open(PROCESSED_IDS_FILE, 'a') as f:
+        f.writelines(f"{msg_id}\n" for msg_id in msg_ids)
 
-                print(f"\n--- Processing Email ID: {msg_id} ---")
-                message = get_email_details(gmail_service, msg_id)
-                if not message:
-                    continue
+async def analyze_batch_with_gemini(prepared):
+    """Analyzes (parsed_email, graph_context) pairs with Gemini concurrently, preserving order."""
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
 
-                parsed_email = parse_email(message)
-                sender_email = parsed_email.get('sender')
-                recipient_email = parsed_email.get('recipient')  # Our target user
-                timestamp_ms = message.get('internalDate')  # Get timestamp
+    async def analyze(parsed_email, graph_context):
+        async with semaphore:
+            return await analyze_with_gemini(parsed_email, graph_context)
 
-                if not sender_email:
-                     print("  Skipping email: Could not determine sender address.")
-                     # Optionally mark as read here if needed
-                     continue  # Skip if no sender identified
+    return await asyncio.gather(*(analyze(pe, gc) for pe, gc in prepared))
 
-                print(f"  Subject: {parsed_email.get('headers', {}).get('subject', 'N/A')}")
-                print(f"  From: {parsed_email.get('headers', {}).get('from', 'N/A')} ({sender_email})")
-                print(f"  To: {recipient_email}")  # Confirm recipient
+async def process_batch(gmail_service, session, batch_ids, processed_ids):
+    """Analyzes a batch of emails end to end and returns how many were analyzed.
 
-                # --- Core Analysis Flow ---
-                # 1. Traditional Checks
-                traditional_results = perform_traditional_checks(parsed_email)
+    Only analyzed emails and emails skipped on purpose are checkpointed; emails that hit
+    a Gmail, Gemini or Neo4j error are left for a later attempt.
+    """
+    processed_count = 0
+    done_ids = []  # Analyzed or deliberately skipped
+
+    # Fetch headers/metadata of the whole batch in one batched round trip
+    messages = get_email_details_batch(gmail_service, batch_ids)
+
+    # --- Core Analysis Flow ---
+    prepared = []
+    for msg_id in batch_ids:
+        message = messages.get(msg_id)
+        if not message:
+            continue
+
+        parsed_email = parse_email(message)
+        sender_email = parsed_email.get('sender')
+        recipient_email = parsed_email.get('recipient')  # Our target user
+
+        if not sender_email:
+             logger.info("event=email_skipped msg_id=%s reason=no_sender", msg_id)
+             done_ids.append(msg_id)
+             # Optionally mark as read here if needed
+             continue  # Skip if no sender identified
+
+        logger.debug("event=email_parsed msg_id=%s sender=%s recipient=%s subject=%r",
+                     msg_id, sender_email, recipient_email, parsed_email.get('headers', {}).get('subject', 'N/A'))
+
+        # 1. Traditional Checks
+        traditional_results = perform_traditional_checks(parsed_email)
+
+        prepared.append((message, parsed_email, traditional_results))
+
+    # Download bodies only for emails that passed the filters above
+    full_messages = get_email_details_batch(
+        gmail_service, [message['id'] for message, _, _ in prepared], full=True
+    )
+    fetched = []
+    for message, parsed_email, traditional_results in prepared:
+        full_message = full_messages.get(message['id'])
+        if not full_message:
+            # Left unrecorded so a later run retries it, instead of scoring an empty body
+            logger.warning("event=email_deferred msg_id=%s reason=body_fetch_failed", message['id'])
+            continue
+        parsed_email['body'] = extract_body(full_message.get('payload', {}))
+        fetched.append((message, parsed_email, traditional_results))
+    prepared = fetched
+
+    # 2. Query Graph DB for Context, all pairs of the batch in one query
+    contexts = get_communication_contexts(
+        session, [(parsed_email['sender'], parsed_email['recipient']) for _, parsed_email, _ in prepared]
+    )
+    graph_contexts = [contexts[(parsed_email['sender'], parsed_email['recipient'])] for _, parsed_email, _ in prepared]
+
+    # The graph was read before any email of this batch is written, so count earlier
+    # emails of the same pair in the batch as history, as sequential processing would
+    seen_in_batch = {}
+    for index, (_, parsed_email, _) in enumerate(prepared):
+        pair = (parsed_email['sender'], parsed_email['recipient'])
+        earlier = seen_in_batch.get(pair, 0)
+        if earlier:
+            graph_context = graph_contexts[index]
+            graph_contexts[index] = {
+                **graph_context,
+                "history_exists": True,
+                "communication_count": graph_context["communication_count"] + earlier,
+            }
+        seen_in_batch[pair] = earlier + 1
+
+    # 3. Analyze with Gemini (using Graph Context), all emails of the batch at once
+    gemini_batch = await analyze_batch_with_gemini(
+        [(parsed_email, graph_context) for (_, parsed_email, _), graph_context in zip(prepared, graph_contexts)]
+    )
+
+    graph_rows = []
+    analyzed_ids = []
+    for (message, parsed_email, traditional_results), graph_context, gemini_results in zip(prepared, graph_contexts, gemini_batch):
+        msg_id = message['id']
+        timestamp_ms = message.get('internalDate')  # Get timestamp
+
+        if gemini_results.get('retryable'):
+            logger.warning("event=email_deferred msg_id=%s reason=gemini_error", msg_id)
+            continue
+
+        # 4. Calculate Final Risk (using all inputs)
+        final_risk, score, reasons = calculate_risk_score(
+            traditional_results, gemini_results, graph_context
+        )
+
+        # 5. Queue the Graph DB update (after analysis)
+        if timestamp_ms:  # Only update if we have a timestamp
+            graph_rows.append({
+                "sender": parsed_email['sender'],
+                "recipient": parsed_email['recipient'],
+                "msg_id": msg_id,
+                "ts_ms": int(timestamp_ms),  # Gmail provides timestamp in ms epoch
+                "risk_lvl": final_risk
+            })
+        else:
+            logger.warning("event=graph_update_skipped msg_id=%s reason=no_timestamp", msg_id)
+
+        # --- Output Results ---
+        logger.info("event=analysis_complete msg_id=%s risk=%s score=%d reasons=%r",
+                    msg_id, final_risk, score, reasons)
+
+        # Mark as read (use cautiously with modify scope)
+        # mark_email_as_read(gmail_service, msg_id)
+
+        analyzed_ids.append(msg_id)
+        processed_count += 1
+
+    # Record the whole batch in the graph with one statement
+    write_contexts = add_communications_to_graph(session, graph_rows)
+    for message, parsed_email, _ in prepared:
+        write_context = write_contexts.get(message['id'])
+        # History can change between the read and the write (e.g. a concurrent run). Both
+        # counts are pre-batch, so compare with the read before the in-batch adjustment.
+        read_count = contexts[(parsed_email['sender'], parsed_email['recipient'])]["communication_count"]
+        if write_context and write_context["communication_count"] != read_count:
+            logger.info("event=graph_history_changed msg_id=%s prior_emails_read=%s prior_emails_write=%s",
+                        message['id'], read_count, write_context['communication_count'])
+
+    # Checkpoint skipped/analyzed emails so they aren't picked up again; an email whose
+    # graph write failed is retried so the graph doesn't miss it
+    written_ids = {row["msg_id"] for row in graph_rows}
+    done_ids.extend(msg_id for msg_id in analyzed_ids if msg_id not in written_ids or msg_id in write_contexts)
+    processed_ids.update(done_ids)
+    checkpoint_processed_ids(done_ids)
+    return processed_count
+
+async def poll_inbox(gmail_service, session, processed_ids, max_to_process=5):
+    """Polls for unread emails until max_to_process have been analyzed or none are left."""
+    processed_count = 0
+    attempted_ids = set()  # Emails that failed stay unread; try each at most once per run
+    while processed_count < max_to_process:
+        batch_ids = fetch_unread_emails(
+            gmail_service, max_results=max_to_process - processed_count, skip_ids=processed_ids | attempted_ids
+        )
+
+        if not batch_ids:
+            logger.info("event=inbox_drained")
+            break
+
+        attempted_ids.update(batch_ids)
+        processed_count += await process_batch(gmail_service, session, batch_ids, processed_ids)
+    return processed_count
+
+async def watch_inbox(gmail_service, session, processed_ids):
+    """Analyzes new inbox emails as Gmail Pub/Sub notifications arrive, until interrupted."""
+    # Imported here so polling mode doesn't pay for loading the Pub/Sub client
+    from google.cloud import pubsub_v1
+
+    if GOOGLE_SERVICE_ACCOUNT_FILE and os.path.exists(GOOGLE_SERVICE_ACCOUNT_FILE):
+        subscriber = pubsub_v1.SubscriberClient.from_service_account_file(GOOGLE_SERVICE_ACCOUNT_FILE)
+    else:
+        subscriber = pubsub_v1.SubscriberClient()  # Application Default Credentials
 
-                # 2. Query Graph DB for Context
-                graph_context = get_communication_context(neo4j_driver, sender_email, recipient_email)
+    history_id = start_inbox_watch(gmail_service)['historyId']
+    watch_started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    notifications = asyncio.Queue()
 
-                # 3. Analyze with Gemini (using Graph Context)
-                gemini_results = analyze_with_gemini(parsed_email, graph_context)
+    def on_notification(message):
+        # Runs on a Pub/Sub worker thread; hand the wake-up over to the event loop
+        message.ack()
+        loop.call_soon_threadsafe(notifications.put_nowait, message.data)
 
-                # 4. Calculate Final Risk (using all inputs)
-                final_risk, score, reasons = calculate_risk_score(
-                    traditional_results, gemini_results, graph_context
-                )
+    streaming_pull = subscriber.subscribe(GMAIL_PUBSUB_SUBSCRIPTION, callback=on_notification)
+    logger.info("event=listening subscription=%s stop=ctrl-c", GMAIL_PUBSUB_SUBSCRIPTION)
 
-                # 5. Update Graph DB (after analysis)
-                if timestamp_ms:  # Only update if we have a timestamp
-                    add_communication_to_graph(
-                        neo4j_driver, sender_email, recipient_email, msg_id, timestamp_ms, final_risk
-                    )
+    processed_count = 0
+    attempts = {}  # Failed email ID -> attempts so far
+    try:
+        while True:
+            # Gmail stops publishing after 7 days unless the watch is renewed
+            renew_in = GMAIL_WATCH_RENEW_INTERVAL - (time.monotonic() - watch_started)
+            try:
+                await asyncio.wait_for(notifications.get(), timeout=max(renew_in, 0))
+            except asyncio.TimeoutError:
+                if renew_inbox_watch(gmail_service) is not None:
+                    watch_started = time.monotonic()
                 else:
-                    print("  Skipping graph update: Missing timestamp.")
+                    # Next wake-up after the retry delay (sooner if a notification arrives)
+                    watch_started = time.monotonic() - GMAIL_WATCH_RENEW_INTERVAL + GMAIL_WATCH_RETRY_DELAY
+                continue
+
+            # One history query covers every notification that arrived meanwhile
+            while not notifications.empty():
+                notifications.get_nowait()
+
+            try:
+                msg_ids, history_id = fetch_new_message_ids(gmail_service, history_id)
+            except HistoryExpiredError:
+                # Restart from a fresh watch and catch up on whatever is still unread
+                logger.warning("event=history_expired history_id=%s", history_id)
+                renewed_history_id = renew_inbox_watch(gmail_service)
+                if renewed_history_id is not None:
+                    history_id = renewed_history_id
+                    watch_started = time.monotonic()
+                # On failure the stale ID expires again at the next notification, retrying the resync
+                msg_ids = fetch_unread_emails(gmail_service, max_results=GMAIL_BATCH_LIMIT, skip_ids=processed_ids)
+            # History won't list emails that failed earlier again, so carry them over
+            new_ids = [msg_id for msg_id in dict.fromkeys([*attempts, *msg_ids]) if msg_id not in processed_ids]
+            if new_ids:
+                processed_count += await process_batch(gmail_service, session, new_ids, processed_ids)
+            for msg_id in new_ids:
+                if msg_id in processed_ids:
+                    attempts.pop(msg_id, None)
+                    continue
+                attempts[msg_id] = attempts.get(msg_id, 0) + 1
+                if attempts[msg_id] >= MAX_EMAIL_ATTEMPTS:
+                    logger.warning("event=email_dropped msg_id=%s attempts=%d", msg_id, attempts.pop(msg_id))
+    finally:
+        streaming_pull.cancel()
+        subscriber.close()
+    return processed_count
 
-                # --- Output Results ---
-                print(f"\n--- ANALYSIS COMPLETE (ID: {msg_id}) ---")
-                print(f"  Final Risk Level: {final_risk} (Score: {score})")
-                print(f"  Reasons / Key Findings:")
-                for reason in reasons:
-                    print(f"    - {reason}")
-                print("----------------------------------------")
+async def main():
+    logger.info("event=starting mode=%s", "watch" if GMAIL_PUBSUB_TOPIC and GMAIL_PUBSUB_SUBSCRIPTION else "poll")
+    if not neo4j_driver:
+        logger.error("event=exiting reason=no_neo4j_connection")
+        return
+    ensure_schema(neo4j_driver)
 
-                # Mark as read (use cautiously with modify scope)
-                # mark_email_as_read(gmail_service, msg_id)
+    gmail_service = get_gmail_service()
+    if not gmail_service:
+        return
 
-                processed_count += 1
-                time.sleep(2)  # Slightly longer delay for Neo4j + Gemini calls
+    processed_count = 0
+    max_to_process = 5
+    processed_ids = load_processed_ids()
+
+    try:  # Wrap main loop to ensure driver closes
+        # One session for the whole run; graph reads and writes are batched per cycle
+        with neo4j_driver.session(database="neo4j") as session:
+            if GMAIL_PUBSUB_TOPIC and GMAIL_PUBSUB_SUBSCRIPTION:
+                processed_count = await watch_inbox(gmail_service, session, processed_ids)
+            else:
+                processed_count = await poll_inbox(gmail_service, session, processed_ids, max_to_process)
 
     finally:
         # Ensure Neo4j driver is closed gracefully when script exits/fails
         if neo4j_driver:
             neo4j_driver.close()
-            print("\nNeo4j driver closed.")
+            logger.info("event=neo4j_closed")
 
-    print(f"\nFinished processing. Analyzed {processed_count} emails.")
+    logger.info("event=finished analyzed=%d", processed_count)
+    cache_info = context_cache_info()
+    logger.info("event=context_cache hits=%d misses=%d size=%d maxsize=%d",
+                cache_info['hits'], cache_info['misses'], cache_info['size'], cache_info['maxsize'])
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    asyncio.run(main())